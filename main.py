@@ -1,14 +1,18 @@
 import html
-import json
 import logging
 import traceback
-from io import StringIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import BytesIO
 from os import makedirs
 from tempfile import TemporaryFile
 from typing import Optional
 from urllib.parse import urlsplit
 
+import orjson
 import requests
+from cachetools.func import ttl_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 try:
     import re2 as re
@@ -24,6 +28,21 @@ from config import BOT_TOKEN, DEVELOPER_ID, IS_BOT_PRIVATE
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Shared session so connections to t.co, vxtwitter and twimg are kept alive and reused
+SESSION = requests.Session()
+SESSION.headers.update({'User-Agent': 'twitter_downloader_bot', 'Accept-Encoding': 'gzip'})
+# Only retry failed connections, never sleep on Retry-After from a rate limited host
+_retry = Retry(total=2, read=0, backoff_factor=0.2, respect_retry_after_header=False)
+_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=_retry)
+SESSION.mount('https://', _adapter)
+SESSION.mount('http://', _adapter)
+
+_TWEET_ID_PATTERN = r"(?:twitter|x)\.com/.{1,15}/(?:web|status(?:es)?)/([0-9]{1,20})"
+_TWEET_ID_RE = re.compile(_TWEET_ID_PATTERN)
+# t.co links and tweet IDs found in a single scan of the message text
+_MESSAGE_LINK_RE = re.compile(r"(t\.co/[a-zA-Z0-9]+)|" + _TWEET_ID_PATTERN)
+_OG_DESC_RE = re.compile(r'<meta content="(.*?)" property="og:description" />')
+
 class APIException(Exception):
     pass
 
@@ -32,83 +51,132 @@ def extract_tweet_ids(update: Update) -> Optional[list[str]]:
     text = update.effective_message.text
 
     # For t.co links
-    unshortened_links = ''
-    for link in re.findall(r"t\.co\/[a-zA-Z0-9]+", text):
+    def unshorten(link: str) -> Optional[str]:
         try:
-            unshortened_link = requests.get('https://' + link).url
-            unshortened_links += '\n' + unshortened_link
+            r = SESSION.head('https://' + link, allow_redirects=True, timeout=(5, 15))
+            if r.status_code == 405:
+                # HEAD refused, only read the headers of a streamed GET
+                with SESSION.get('https://' + link, allow_redirects=True, stream=True, timeout=(5, 15)) as r:
+                    pass
+            unshortened_link = r.url
             log_handling(update, 'info', f'Unshortened t.co link [https://{link} -> {unshortened_link}]')
+            return unshortened_link
         except:
             log_handling(update, 'info', f'Could not unshorten link [https://{link}]')
+            return None
+
+    links = []
+    tweet_ids = []
+    for match in _MESSAGE_LINK_RE.finditer(text):
+        if match.group(1):
+            links.append(match.group(1))
+        else:
+            tweet_ids.append(match.group(2))
+
+    if links:
+        with ThreadPoolExecutor(max_workers=min(8, len(links))) as executor:
+            for unshortened_link in executor.map(unshorten, links):
+                if unshortened_link:
+                    tweet_ids.extend(_TWEET_ID_RE.findall(unshortened_link))
 
-    # Parse IDs from received text
-    tweet_ids = re.findall(r"(?:twitter|x)\.com/.{1,15}/(?:web|status(?:es)?)/([0-9]{1,20})", text + unshortened_links)
     tweet_ids = list(dict.fromkeys(tweet_ids))
     return tweet_ids or None
 
+@ttl_cache(maxsize=1024, ttl=600)
 def scrape_media(tweet_id: int) -> tuple[list[dict], str]:
-    r = requests.get(f'https://api.vxtwitter.com/Twitter/status/{tweet_id}')
+    r = SESSION.get(f'https://api.vxtwitter.com/Twitter/status/{tweet_id}', timeout=(5, 15))
     r.raise_for_status()
     try:
-        data = r.json()
+        data = orjson.loads(r.content)
         return data['media_extended'], data.get('text', '')
-    except requests.exceptions.JSONDecodeError:
-        if match := re.search(r'<meta content="(.*?)" property="og:description" />', r.text):
+    except orjson.JSONDecodeError:
+        if match := _OG_DESC_RE.search(r.text):
             raise APIException(f'API returned error: {html.unescape(match.group(1))}')
         raise
 
 def reply_media(update: Update, context: CallbackContext, tweet_media: list, tweet_text: str) -> bool:
     """Reply to message with supported media."""
-    photos = [media for media in tweet_media if media["type"] == "image"]
-    gifs = [media for media in tweet_media if media["type"] == "gif"]
-    videos = [media for media in tweet_media if media["type"] == "video"]
+    buckets = {'image': [], 'gif': [], 'video': []}
+    for media in tweet_media:
+        if (bucket := buckets.get(media['type'])) is not None:
+            bucket.append(media)
+    photos, gifs, videos = buckets['image'], buckets['gif'], buckets['video']
+    replies = []
     if photos:
-        reply_photos(update, context, photos, tweet_text)
+        replies.append((reply_photos, photos))
     if gifs:
-        reply_gifs(update, context, gifs, tweet_text)
+        replies.append((reply_gifs, gifs))
     elif videos:
-        reply_videos(update, context, videos, tweet_text)
-    return bool(photos or gifs or videos)
+        replies.append((reply_videos, videos))
+    if replies:
+        # Media groups are sent independently, so send them concurrently
+        media_downloaded = 0
+        failed = 0
+        with ThreadPoolExecutor(max_workers=len(replies)) as executor:
+            futures = [executor.submit(reply, update, context, media, tweet_text) for reply, media in replies]
+            for future in as_completed(futures):
+                try:
+                    media_downloaded += future.result()
+                except Exception as exc:
+                    log_handling(update, 'error', 'Error occurred when sending media: ' + ''.join(
+                        traceback.format_exception(None, exc, exc.__traceback__)))
+                    failed += 1
+        context.bot_data['stats']['media_downloaded'] += media_downloaded
+        if failed == len(replies):
+            update.effective_message.reply_text('Error occurred when sending media', quote=True)
+    return bool(replies)
+
+# Telegram errors meaning it could not fetch a media url of the group
+_MEDIA_URL_ERRORS = ('wrong file identifier', 'failed to get http url content', 'wrong type of the web page content',
+                     'webpage_media_empty', 'webpage_curl_failed', 'group send failed')
 
-def reply_photos(update: Update, context: CallbackContext, twitter_photos: list[dict], tweet_text: str) -> None:
-    """Reply with photo group."""
-    photo_group = []
-    for i, photo in enumerate(twitter_photos):
+def reply_photos(update: Update, context: CallbackContext, twitter_photos: list[dict], tweet_text: str) -> int:
+    """Reply with photo group. Return number of sent photos."""
+    caption = tweet_text[:1024]
+    photo_urls = []
+    orig_urls = []
+    for photo in twitter_photos:
         photo_url = photo['url']
-        log_handling(update, 'info', f'Photo[{len(photo_group)}] url: {photo_url}')
-        parsed_url = urlsplit(photo_url)
+        log_handling(update, 'info', f'Photo[{len(photo_urls)}] url: {photo_url}')
+        # Request 'orig' quality, Telegram fetches it on its side
+        new_url = urlsplit(photo_url)._replace(query='format=jpg&name=orig').geturl()
+        log_handling(update, 'info', 'New photo url: ' + new_url)
+        photo_urls.append(photo_url)
+        orig_urls.append(new_url)
 
-        # Try changing requested quality to 'orig'
-        try:
-            new_url = parsed_url._replace(query='format=jpg&name=orig').geturl()
-            log_handling(update, 'info', 'New photo url: ' + new_url)
-            requests.head(new_url).raise_for_status()
-            photo_group.append(InputMediaPhoto(media=new_url, caption=tweet_text[:1024] if i == 0 else None))
-        except requests.HTTPError:
-            log_handling(update, 'info', 'orig quality not available, using original url')
-            photo_group.append(InputMediaPhoto(media=photo_url, caption=tweet_text[:1024] if i == 0 else None))
-    update.effective_message.reply_media_group(photo_group, quote=True)
-    log_handling(update, 'info', f'Sent photo group (len {len(photo_group)})')
-    context.bot_data['stats']['media_downloaded'] += len(photo_group)
-
-def reply_gifs(update: Update, context: CallbackContext, twitter_gifs: list[dict], tweet_text: str):
-    """Reply with GIF animations."""
+    def build_group(urls: list[str]) -> list[InputMediaPhoto]:
+        return [InputMediaPhoto(media=url, caption=caption if i == 0 else None) for i, url in enumerate(urls)]
+
+    try:
+        update.effective_message.reply_media_group(build_group(orig_urls), quote=True)
+    except telegram.error.BadRequest as exc:
+        if not any(err in exc.message.lower() for err in _MEDIA_URL_ERRORS):
+            raise
+        log_handling(update, 'info', f'orig quality not available ({exc.message}), using original url')
+        update.effective_message.reply_media_group(build_group(photo_urls), quote=True)
+    log_handling(update, 'info', f'Sent photo group (len {len(photo_urls)})')
+    return len(photo_urls)
+
+def reply_gifs(update: Update, context: CallbackContext, twitter_gifs: list[dict], tweet_text: str) -> int:
+    """Reply with GIF animations. Return number of sent gifs."""
+    caption = tweet_text[:1024]
     for gif in twitter_gifs:
         gif_url = gif['url']
         log_handling(update, 'info', f'Gif url: {gif_url}')
-        update.effective_message.reply_animation(animation=gif_url, caption=tweet_text[:1024], quote=True)
+        update.effective_message.reply_animation(animation=gif_url, caption=caption, quote=True)
         log_handling(update, 'info', 'Sent gif')
-        context.bot_data['stats']['media_downloaded'] += 1
+    return len(twitter_gifs)
 
-def reply_videos(update: Update, context: CallbackContext, twitter_videos: list[dict], tweet_text: str):
-    """Reply with videos and tweet text."""
+def reply_videos(update: Update, context: CallbackContext, twitter_videos: list[dict], tweet_text: str) -> int:
+    """Reply with videos and tweet text. Return number of handled videos."""
+    caption = tweet_text[:1024]
     for video in twitter_videos:
         video_url = video['url']
         try:
-            request = requests.get(video_url, stream=True)
-            request.raise_for_status()
-            if (video_size := int(request.headers['Content-Length'])) <= constants.MAX_FILESIZE_DOWNLOAD:
-                update.effective_message.reply_video(video=video_url, caption=tweet_text[:1024], quote=True)
+            head = SESSION.head(video_url, allow_redirects=True, timeout=(5, 15))
+            head.raise_for_status()
+            if (video_size := int(head.headers['Content-Length'])) <= constants.MAX_FILESIZE_DOWNLOAD:
+                update.effective_message.reply_video(video=video_url, caption=caption, quote=True)
                 log_handling(update, 'info', 'Sent video (download)')
             elif video_size <= constants.MAX_FILESIZE_UPLOAD:
                 log_handling(update, 'info', f'Video size ({video_size}) is bigger than '
@@ -117,26 +185,28 @@ def reply_videos(update: Update, context: CallbackContext, twitter_videos: list[
                     'Video is too large for direct download\nUsing upload method '
                     '(this might take a bit longer)',
                     quote=True)
-                with TemporaryFile() as tf:
+                with TemporaryFile() as tf, \
+                        SESSION.get(video_url, stream=True, timeout=(5, 30)) as request:
+                    request.raise_for_status()
                     log_handling(update, 'info', f'Downloading video (Content-length: '
                                                 f'{request.headers["Content-length"]})')
-                    for chunk in request.iter_content(chunk_size=128):
+                    for chunk in request.iter_content(chunk_size=256 * 1024):
                         tf.write(chunk)
                     log_handling(update, 'info', 'Video downloaded, uploading to Telegram')
                     tf.seek(0)
-                    update.effective_message.reply_video(video=tf, caption=tweet_text[:1024], quote=True, supports_streaming=True)
+                    update.effective_message.reply_video(video=tf, caption=caption, quote=True, supports_streaming=True)
                     log_handling(update, 'info', 'Sent video (upload)')
                 message.delete()
             else:
                 log_handling(update, 'info', 'Video is too large, sending direct link')
                 update.effective_message.reply_text(f'Video is too large for Telegram upload. Direct video link:\n'
-                                        f'{video_url}\n\nTweet text:\n{tweet_text[:1024]}', quote=True)
-        except (requests.HTTPError, KeyError, telegram.error.BadRequest, requests.exceptions.ConnectionError) as exc:
+                                        f'{video_url}\n\nTweet text:\n{caption}', quote=True)
+        except (requests.RequestException, KeyError, telegram.error.BadRequest) as exc:
             log_handling(update, 'info', f'{exc.__class__.__qualname__}: {exc}')
             log_handling(update, 'info', 'Error occurred when trying to send video, sending direct link')
             update.effective_message.reply_text(f'Error occurred when trying to send video. Direct link:\n'
-                                    f'{video_url}\n\nTweet text:\n{tweet_text[:1024]}', quote=True)
-        context.bot_data['stats']['media_downloaded'] += 1
+                                    f'{video_url}\n\nTweet text:\n{caption}', quote=True)
+    return len(twitter_videos)
 
 def log_handling(update: Update, level: str, message: str) -> None:
     """Log message with chat_id and message_id."""
@@ -154,27 +224,16 @@ def error_handler(update: object, context: CallbackContext) -> None:
     if update is None:
         return
     tb_list = traceback.format_exception(None, context.error, context.error.__traceback__)
-    tb_string = ''.join(tb_list)
     update_str = update.to_dict() if isinstance(update, Update) else str(update)
-    message = (
-        f'#error_report\n'
-        f'An exception was raised in runtime\n'
-        f'<pre>update = {html.escape(json.dumps(update_str, indent=2, ensure_ascii=False))}'
-        '</pre>\n\n'
-        f'<pre>context.chat_data = {html.escape(str(context.chat_data))}</pre>\n\n'
-        f'<pre>context.user_data = {html.escape(str(context.user_data))}</pre>\n\n'
-        f'<pre>{html.escape(tb_string)}</pre>'
-    )
     logger.info('Sending error report')
-    message = (
-        f'update = {json.dumps(update_str, indent=2, ensure_ascii=False)}'
-        '\n\n'
-        f'context.chat_data = {str(context.chat_data)}\n\n'
-        f'context.user_data = {str(context.user_data)}\n\n'
-        f'{tb_string}'
-    )
-    string_out = StringIO(message)
-    context.bot.send_document(chat_id=DEVELOPER_ID, document=string_out, filename='error_report.txt',
+    message = ''.join([
+        'update = ', orjson.dumps(update_str, option=orjson.OPT_INDENT_2).decode(), '\n\n',
+        'context.chat_data = ', str(context.chat_data), '\n\n',
+        'context.user_data = ', str(context.user_data), '\n\n',
+        *tb_list,
+    ])
+    bytes_out = BytesIO(message.encode('utf-8'))
+    context.bot.send_document(chat_id=DEVELOPER_ID, document=bytes_out, filename='error_report.txt',
                               caption='#error_report\nAn exception was raised in runtime\n')
     if update:
         error_class_name = ".".join([context.error.__class__.__module__, context.error.__class__.__qualname__])
@@ -195,12 +254,10 @@ def help_command(update: Update, context: CallbackContext) -> None:
 
 def stats_command(update: Update, context: CallbackContext) -> None:
     """Send stats when the command /stats is issued."""
-    if not 'stats' in context.bot_data:
-        context.bot_data['stats'] = {'messages_handled': 0, 'media_downloaded': 0}
-        logger.info('Initialized stats')
-    logger.info(f'Sent stats: {context.bot_data["stats"]}')
-    update.effective_message.reply_text(f'*Bot stats:*\nMessages handled: *{context.bot_data["stats"].get("messages_handled")}*'
-                                     f'\nMedia downloaded: *{context.bot_data["stats"].get("media_downloaded")}*')
+    stats = context.bot_data['stats']
+    logger.info(f'Sent stats: {stats}')
+    update.effective_message.reply_text(f'*Bot stats:*\nMessages handled: *{stats.get("messages_handled")}*'
+                                     f'\nMedia downloaded: *{stats.get("media_downloaded")}*')
 
 def reset_stats_command(update: Update, context: CallbackContext) -> None:
     """Reset stats when the command /resetstats is issued."""
@@ -219,10 +276,8 @@ def deny_access(update: Update, context: CallbackContext) -> None:
 def handle_message(update: Update, context: CallbackContext) -> None:
     """Handle the user message. Reply with found supported media."""
     log_handling(update, 'info', 'Received message: ' + update.effective_message.text.replace("\n", ""))
-    if not 'stats' in context.bot_data:
-        context.bot_data['stats'] = {'messages_handled': 0, 'media_downloaded': 0}
-        logger.info('Initialized stats')
-    context.bot_data['stats']['messages_handled'] += 1
+    stats = context.bot_data['stats']
+    stats['messages_handled'] += 1
 
     if tweet_ids := extract_tweet_ids(update):
         log_handling(update, 'info', f'Found Tweet IDs {tweet_ids} in message')
@@ -232,10 +287,15 @@ def handle_message(update: Update, context: CallbackContext) -> None:
         return
     found_media = False
     found_tweets = False
-    for tweet_id in tweet_ids:
-        log_handling(update, 'info', f'Scraping tweet ID {tweet_id}')
+    # Scrape all tweets concurrently, replies are still sent in message order
+    with ThreadPoolExecutor(max_workers=min(8, len(tweet_ids))) as executor:
+        scraped = {}
+        for tweet_id in tweet_ids:
+            log_handling(update, 'info', f'Scraping tweet ID {tweet_id}')
+            scraped[tweet_id] = executor.submit(scrape_media, tweet_id)
+    for tweet_id, future in scraped.items():
         try:
-            media, tweet_text = scrape_media(tweet_id)
+            media, tweet_text = future.result()
             found_tweets = True
             if media:
                 log_handling(update, 'info', f'tweet media: {media}')
@@ -265,9 +325,11 @@ def main() -> None:
     """Start the bot."""
     makedirs('data', exist_ok=True)
     persistence = PicklePersistence(filename='data/persistence')
-    updater = Updater(BOT_TOKEN, persistence=persistence)
+    updater = Updater(BOT_TOKEN, persistence=persistence, workers=16,
+                      request_kwargs={'con_pool_size': 32, 'read_timeout': 30, 'connect_timeout': 15})
     dispatcher = updater.dispatcher
     bot = dispatcher.bot
+    dispatcher.bot_data.setdefault('stats', {'messages_handled': 0, 'media_downloaded': 0})
 
     dispatcher.add_handler(CommandHandler("stats", stats_command, Filters.chat(DEVELOPER_ID)))
     dispatcher.add_handler(CommandHandler("resetstats", reset_stats_command, Filters.chat(DEVELOPER_ID)))